@@ -0,0 +1,105 @@
+import atexit
+import os
+import queue
+import threading
+import cv2
+
+# preview pngs and layer dumps are encoded on a background thread so they don't
+# block the compression. errors there are only printed since these are debug
+# output. the queue is bounded, so a slow disk only makes write()
+# wait instead of piling up images in memory
+
+class ArtifactWriter:
+    def __init__(self, maxsize=8, in_memory=False):
+        # in_memory keeps the encoded files in self.encoded instead of writing them
+        self.in_memory = in_memory
+        self.encoded = {}
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            path,img = item
+            try:
+                if isinstance(img, bytes):
+                    data = img
+                else:
+                    ok,buf = cv2.imencode(os.path.splitext(path)[1], img)
+                    data = buf.tobytes() if ok else None
+                if data is None:
+                    print("could not encode", path)
+                elif self.in_memory:
+                    self.encoded[path] = data
+                else:
+                    if os.path.dirname(path):
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                    f = open(path,"wb")
+                    f.write(data)
+                    f.close()
+            except Exception as e:
+                print("could not write", path, e)
+            self.queue.task_done()
+
+    def write(self, path, img):
+        # img is encoded later, don't modify it after passing it here.
+        # bytes are stored as they are
+        if not self.thread.is_alive():
+            raise RuntimeError("artifact writer is closed")
+        self.queue.put((path,img))
+
+    def flush(self):
+        # waits for everything queued so far. returns the encoded files in in_memory mode
+        self.queue.join()
+        return self.encoded
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        atexit.unregister(self.close)
+        return self.encoded
+
+
+writer = None
+
+def getWriter(in_memory=None):
+    # in_memory=None keeps whatever the current writer does, otherwise a writer
+    # of the other kind is closed and replaced
+    global writer
+    if writer is not None and in_memory is not None and writer.in_memory != in_memory:
+        closeWriter()
+    if writer is None:
+        writer = ArtifactWriter(in_memory=bool(in_memory))
+    return writer
+
+def closeWriter():
+    # closes the shared writer so the next getWriter() starts a fresh one
+    global writer
+    encoded = {}
+    if writer is not None:
+        encoded = writer.close()
+        writer = None
+    return encoded
+
+def imwrite(path, img):
+    getWriter().write(path, img)
+
+def writeFile(path, data):
+    # for outputs that must not fail quietly (image.pas, reports). written right
+    # away and errors are raised, only in_memory mode hands them to the writer
+    if isinstance(data, str):
+        data = data.encode()
+    if getWriter().in_memory:
+        getWriter().write(path, data)
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    f = open(path,"wb")
+    f.write(data)
+    f.close()
@@ -2,6 +2,11 @@ import cv2.version
 import numpy as np
 import math
 import cv2
+import os
+import atexit
+import artifacts
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 # 8,9,10,11,14,15
 # 8: 320x192
@@ -14,6 +19,7 @@ import cv2
 
 THRESHOLD = False
 BYPASSBGSETTING = False
+WORKERS = None # processes used by genLayerSquares, None = usable cpus
 gr_delta_sum = 0
 
 grmode_dims = [
@@ -34,6 +40,18 @@ grmode_names = [
     "gr15.png"
 ]
 
+grmode_numbers = [8, 9, 10, 11, 14, 15]
+
+# default weighting for -g auto. lowest score wins:
+# score = mean*dE_mean + pct*dE_percentile + kb*kilobytes of raw data
+AUTO_WEIGHTS = {"mean": 1.0, "pct": 0.5, "kb": 1.0}
+AUTO_PERCENTILE = 95
+
+# op tags of the hline stream, see hlineEncode()
+HL_ROW = 0
+HL_SKIP = 1
+HL_REPEAT = 2
+
 grmode_colors = [ 
     [
         "034653",
@@ -151,6 +169,25 @@ def rgb_to_cielab(rgb):
 
     return CIEL, CIEa, CIEb
 
+def rgb_to_cielab_np(rgb):
+    var = np.asarray(rgb, dtype=np.float64) / 255
+    var = np.where(var > 0.04045, ( ( var + 0.055 ) / 1.055 ) ** 2.4, var / 12.92) * 100
+    var_R, var_G, var_B = var[...,0], var[...,1], var[...,2]
+
+    X = var_R * 0.4124 + var_G * 0.3576 + var_B * 0.1805
+    Y = var_R * 0.2126 + var_G * 0.7152 + var_B * 0.0722
+    Z = var_R * 0.0193 + var_G * 0.1192 + var_B * 0.9505
+
+    var = np.stack((X / 95.047, Y / 100.000, Z / 108.883), axis=-1)
+    var = np.where(var > 0.008856, var ** ( 1/3 ), ( 7.787 * var ) + ( 16 / 116 ))
+    var_X, var_Y, var_Z = var[...,0], var[...,1], var[...,2]
+
+    CIEL = ( 116 * var_Y ) - 16
+    CIEa = 500 * ( var_X - var_Y )
+    CIEb = 200 * ( var_Y - var_Z )
+
+    return np.stack((CIEL, CIEa, CIEb), axis=-1)
+
 def str_to_rgb(s):
     return tuple(int(s[i:i+2], 16) for i in (0, 2, 4))
 
@@ -164,6 +201,11 @@ def CieLab2Hue(x, y): # todo: ai gen, check this
     else:
         return 180
 
+def CieLab2Hue_np(x, y):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = np.arctan( y / x ) * 180 / math.pi
+    return np.select([x > 0, (x < 0) & (y >= 0), (x < 0) & (y < 0)], [h, 360 + h, 180 + h], 180)
+
 def deg2rad(x):
     return x * math.pi / 180
 
@@ -234,6 +276,62 @@ def distance(cielab1, cielab2):
     
     return DeltaE00
 
+# same as distance(), but works on whole arrays of cielab colors at once.
+# last axis holds L,a,b and the rest is broadcast, so a (n,1,1,3) palette
+# against a (h,w,3) image gives a (n,h,w) array of deltas
+def distance_np(cielab1, cielab2):
+    cielab1 = np.asarray(cielab1, dtype=np.float64)
+    cielab2 = np.asarray(cielab2, dtype=np.float64)
+    CIEL1, CIEa1, CIEb1 = cielab1[...,0], cielab1[...,1], cielab1[...,2]
+    CIEL2, CIEa2, CIEb2 = cielab2[...,0], cielab2[...,1], cielab2[...,2]
+    WHTL, WHTC, WHTH = (1,1,1) # for weight adjustments
+
+    xC1 = np.sqrt( CIEa1 * CIEa1 + CIEb1 * CIEb1 )
+    xC2 = np.sqrt( CIEa2 * CIEa2 + CIEb2 * CIEb2 )
+    xCX = ( xC1 + xC2 ) / 2
+    xGX = 0.5 * ( 1 - np.sqrt( ( xCX ** 7 ) / ( ( xCX ** 7 ) + ( 25 ** 7 ) ) ) )
+    xNN = ( 1 + xGX ) * CIEa1
+    xC1 = np.sqrt( xNN * xNN + CIEb1 * CIEb1 )
+    xH1 = CieLab2Hue_np( xNN, CIEb1 )
+    xNN = ( 1 + xGX ) * CIEa2
+    xC2 = np.sqrt( xNN * xNN + CIEb2 * CIEb2 )
+    xH2 = CieLab2Hue_np( xNN, CIEb2 )
+    xDL = CIEL2 - CIEL1
+    xDC = xC2 - xC1
+    achromatic = ( xC1 * xC2 ) == 0
+
+    xNN = np.round( xH2 - xH1, 12 )
+    xDH = np.where( np.abs( xNN ) <= 180, xH2 - xH1,
+                   np.where( xNN > 180, xH2 - xH1 - 360, xH2 - xH1 + 360 ) )
+    xDH = np.where( achromatic, 0, xDH )
+
+    xDH = 2 * np.sqrt( xC1 * xC2 ) * np.sin( deg2rad( xDH / 2 ) )
+    xLX = ( CIEL1 + CIEL2 ) / 2
+    xCY = ( xC1 + xC2 ) / 2
+
+    xNN = np.abs( np.round( xH1 - xH2, 12 ) )
+    xHX = np.where( xNN > 180,
+                   np.where( ( xH2 + xH1 ) < 360, xH1 + xH2 + 360, xH1 + xH2 - 360 ),
+                   xH1 + xH2 ) / 2
+    xHX = np.where( achromatic, xH1 + xH2, xHX )
+
+    xTX = 1 - 0.17 * np.cos( deg2rad( xHX - 30 ) ) + 0.24 * np.cos( deg2rad( 2 * xHX ) ) + 0.32 * np.cos( deg2rad( 3 * xHX + 6 ) ) - 0.20 * np.cos( deg2rad( 4 * xHX - 63 ) )
+    xPH = 30 * np.exp( - ( ( xHX  - 275 ) / 25 ) * ( ( xHX  - 275 ) / 25 ) )
+    xRC = 2 * np.sqrt( ( xCY ** 7 ) / ( ( xCY ** 7 ) + ( 25 ** 7 ) ) )
+    xSL = 1 + ( ( 0.015 * ( ( xLX - 50 ) * ( xLX - 50 ) ) )
+            / np.sqrt( 20 + ( ( xLX - 50 ) * ( xLX - 50 ) ) ) )
+
+    xSC = 1 + 0.045 * xCY
+    xSH = 1 + 0.015 * xCY * xTX
+    xRT = - np.sin( deg2rad( 2 * xPH ) ) * xRC
+    xDL = xDL / ( WHTL * xSL )
+    xDC = xDC / ( WHTC * xSC )
+    xDH = xDH / ( WHTH * xSH )
+
+    DeltaE00 = np.sqrt( xDL ** 2 + xDC ** 2 + xDH ** 2 + xRT * xDC * xDH )
+
+    return DeltaE00
+
 def bgr_to_rgb(x):
     return (x[2], x[1], x[0])
 
@@ -252,13 +350,21 @@ def closest_color(gr, x):
     return (str_to_rgb(grmode_colors[gr][color_dmin]),color_dmin)
 
 
+# vectorized version of calling closest_color() on every pixel.
+# returns the per-pixel delta to the chosen color, shape (h,w)
 def posterize(scaled_img, Ti, gr):
-    x2,y2 = grmode_dims[gr]
-    for x1 in range(0, x2):
-        for y1 in range(0, y2):
-            (r,g,b),id = closest_color(gr,scaled_img[y1][x1])
-            scaled_img[y1][x1] = (r,g,b)
-            Ti[x1][y1] = id
+    global gr_delta_sum
+
+    palette = np.array(grmode_prep[gr])
+    deltas = distance_np(palette[:,None,None,:], rgb_to_cielab_np(scaled_img)[None,...])
+    ids = np.argmin(deltas, axis=0)
+    delta_min = np.take_along_axis(deltas, ids[None,...], axis=0)[0]
+    gr_delta_sum += float(delta_min.sum())
+
+    rgb = np.array([str_to_rgb(c) for c in grmode_colors[gr]], np.uint8)
+    scaled_img[:] = rgb[ids]
+    Ti[:] = ids.T
+    return delta_min
 
 def thresh(scaled_img):
     gray = cv2.cvtColor(scaled_img, cv2.COLOR_RGB2GRAY)
@@ -319,17 +425,87 @@ def fillzero(x1,y1,x2,y2,arr):
     return arr
 
 
-def genLayerSquares(tsrt,vc,path):
+def cpuCount():
+    # respects cpu affinity (taskset, containers) where the platform supports it
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+pool = None
+
+def getPool(workers):
+    # one pool for the whole process, so -g auto doesn't start a new one for every
+    # mode and compression. it is only replaced when the worker count changes
+    global pool
+    if pool is not None and pool._max_workers != workers:
+        closePool()
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    return pool
+
+def closePool():
+    global pool
+    if pool is not None:
+        pool.shutdown()
+        pool = None
+
+atexit.register(closePool)
+
+def _squareifyShared(shm_name,shape,i,vc):
+    # runs in a pool worker. layer i only reads the original masks of layers i..n
+    # and only modifies its own (copied) mask, so layers can be done in any order
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        masks = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        can_override = [(masks[j],0,j) for j in range(i,shape[0])]
+        squares = squareify(masks[i].copy(),can_override,vc)
+        del masks,can_override
+    finally:
+        shm.close()
+    return squares
+
+def dumpLayers(tsrt,path):
+    for layer,count,name in tsrt:
+        artifacts.imwrite(f"{path}layer_{name}.png", (layer*255).astype(np.uint8))
+
+def genLayerSquares(tsrt,vc,path,workers=None):
+    global squarecount
     layers_squareified = []
     names = []
+    todo = []
+
+    if path:
+        dumpLayers(tsrt,path)
 
     for i in range(len(tsrt)):
         layer,count,name = tsrt[i]
-        if path:
-            cv2.imwrite(f"{path}layer_{name}.png", (layer*255).astype(np.uint8))
         if count >0:
-            layers_squareified.append(squareify(layer,tsrt[i:], vc))
+            todo.append(i)
             names.append(name)
+
+    workers = workers or WORKERS or cpuCount()
+    if workers <= 1 or len(todo) <= 1:
+        for i in todo:
+            layers_squareified.append(squareify(tsrt[i][0],tsrt[i:], vc))
+        return layers_squareified,names
+
+    masks = np.stack([layer for layer,count,name in tsrt]).astype(np.uint8)
+    # pool workers are forked on demand, don't do that while the artifact thread
+    # is in the middle of an encode
+    if artifacts.writer is not None:
+        artifacts.writer.flush()
+    shm = shared_memory.SharedMemory(create=True, size=masks.nbytes)
+    try:
+        shared = np.ndarray(masks.shape, dtype=np.uint8, buffer=shm.buf)
+        shared[:] = masks
+        futures = [getPool(workers).submit(_squareifyShared,shm.name,masks.shape,i,vc) for i in todo]
+        layers_squareified = [f.result() for f in futures]
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+    squarecount += sum(len(s) for s in layers_squareified)
     return layers_squareified,names
 
 def countInImg(img):
@@ -348,13 +524,6 @@ def countInImg(img):
     counts = sorted(ca, key=lambda tup:tup[1], reverse=True)
     return counts
 
-def setOnes(bmp,canoverride):
-    for y in range(len(bmp)):
-        for x in range(len(bmp[0])):
-            if bmp[y][x]:
-                canoverride[y][x] = True
-
-
 def setOnes1(lines,canoverride, vc):
     y = 0
     for x,ctr in lines:
@@ -376,49 +545,64 @@ def setOnes2(x1,x2,y,canoverride, vc):
         canoverride[y][x1+i] = True
     
 
-def genLayerHLines(fwdT,vc,path):
+def hlineRuns(mask,allowed):
+    # mask is the layer, allowed are the pixels that may be painted over because a
+    # later layer draws them again. a run starts at a set pixel and may cross allowed
+    # pixels, but stops before anything drawn earlier. returns a list of runs per row
+    paintable = mask | allowed
+    rows = []
+    for y in range(len(mask)):
+        runs = []
+        xs = np.flatnonzero(mask[y])
+        if len(xs):
+            # pixels in the same run are not separated by a blocked pixel
+            segment = np.cumsum(~paintable[y])[xs]
+            for run in np.split(xs, np.flatnonzero(np.diff(segment))+1):
+                runs.append((int(run[0]),int(run[-1])))
+        rows.append(runs)
+    return rows
+
+def hlineEncode(rows):
+    # HL_ROW n x1 x2 ...  draws n runs on the current row and goes to the next one
+    # HL_SKIP n           skips n empty rows
+    # HL_REPEAT n         draws the runs of the last HL_ROW on the next n rows
+    stream = []
+    last_runs = None
+    last_op = None
+    skip = 0
+    for runs in rows:
+        if not runs:
+            skip += 1
+            continue
+        if skip:
+            last_op = len(stream)
+            stream += [HL_SKIP,skip]
+            skip = 0
+        if runs == last_runs:
+            if last_op is not None and stream[last_op] == HL_REPEAT:
+                stream[last_op+1] += 1
+            else:
+                last_op = len(stream)
+                stream += [HL_REPEAT,1]
+            continue
+        last_op = len(stream)
+        stream += [HL_ROW,len(runs)]
+        for x1,x2 in runs:
+            stream += [x1,x2]
+        last_runs = runs
+    return stream
+
+def genLayerHLines(fwdT,vc):
     layers_lines = []
     layers_names = []
     counts = countInImg(fwdT)
-    flat_canoverride = np.zeros((grmode_dims[vc][0],grmode_dims[vc][1]), np.bool)
+    img = np.asarray(fwdT).T
+    drawn = np.zeros((grmode_dims[vc][1],grmode_dims[vc][0]), np.bool)
     for c in counts:
-        flat_bmp = np.zeros((grmode_dims[vc][0],grmode_dims[vc][1]), np.bool)
-        ctr = 0
-        tmp = []
-        for y in range(len(fwdT[0])):
-            for x in range(len(fwdT)):
-                #print("pos:",x,y,"fwdT:",fwdT[x][y])
-
-                if fwdT[x][y] == c[0]:
-                    ctr += 1
-                    #print("print ctr++:",ctr)
-                    flat_bmp[x][y] = True
-                elif not flat_canoverride[x][y] and (ctr >0):
-                    ctr +=1
-                else:
-                    if ctr !=0:
-                        #print("normal append",x-ctr,ctr)
-                        tmp.append((x-ctr,x-1))
-                        ctr = 0
-
-            if ctr == 0:
-                #print("ctr = 0 append",grmode_dims[vc][1],grmode_dims[vc][1])
-                if len(tmp)>0:
-                    if tmp[-1] == (81,81):
-                        tmp[-1] = (82,2)
-                    elif tmp[-1][0] == 82:
-                        tmp[-1] = (82,tmp[-1][1]+1)
-                    else:
-                        tmp.append((grmode_dims[vc][0]+1,grmode_dims[vc][0]+1))
-                else:
-                        tmp.append((grmode_dims[vc][0]+1,grmode_dims[vc][0]+1))
-            if ctr != 0:
-                tmp.append((grmode_dims[vc][0]-ctr,grmode_dims[vc][0]-1))
-                tmp.append((81,81))
-                ctr = 0
-        setOnes(flat_bmp,flat_canoverride)
-        layers_lines.append(tmp)
+        mask = img == c[0]
+        layers_lines.append(hlineEncode(hlineRuns(mask,~drawn)))
         layers_names.append(c[0])
+        drawn |= mask
     return layers_lines,layers_names
 squarecount = 0
 
@@ -467,4 +651,119 @@ def squareify(todo, can_override, vc):
                     failcount = 0
                     break
     squarecount += len(squares)
-    return squares
\ No newline at end of file
+    return squares
+
+def sortLayers(fwd_T,vc):
+    # layers in drawing order, largest first. the largest one is taken out as the
+    # background unless BYPASSBGSETTING is set
+    layers_T,counts = layerize(fwd_T,vc)
+
+    tsrt = []
+    for i in range(len(grmode_colors[vc])):
+        tsrt.append([layers_T[i], counts[i],i])
+    tsrt = sorted(tsrt, key = lambda x : x[1], reverse=True)
+
+    background_color = None
+    if not BYPASSBGSETTING:
+        background_color = tsrt[0][2]
+        tsrt = tsrt[1:]
+    return tsrt,background_color
+
+def encodeRect(fwd_T,vc,path=None):
+    global squarecount
+    tsrt,background_color = sortLayers(fwd_T,vc)
+
+    squarecount = 0
+    layers_squareified,names = genLayerSquares(tsrt,vc,path)
+    return layers_squareified,names,background_color
+
+def encodeHLine(fwd_T,vc):
+    # hline mode has no layer dumps
+    return genLayerHLines(fwd_T,vc)
+
+def encodeHybrid(fwd_T,vc,path=None,rect=None):
+    # every layer is encoded both ways and the smaller one is kept. both encoders may
+    # paint over exactly the same pixels (this layer and the ones drawn after it),
+    # so rect and hline layers can be mixed freely in one program.
+    # rect can be the result of encodeRect() for the same image to skip squareify
+    global squarecount
+    tsrt,background_color = sortLayers(fwd_T,vc)
+    # squareify clears the layers it works on, so keep the masks
+    masks = [layer.astype(np.bool) for layer,count,name in tsrt]
+
+    if rect is not None:
+        layers_squareified,names,_ = rect
+    else:
+        squarecount = 0
+        layers_squareified,names = genLayerSquares(tsrt,vc,path)
+
+    layers = []
+    later = np.zeros((grmode_dims[vc][1],grmode_dims[vc][0]), np.bool)
+    allowed = [None]*len(tsrt)
+    for i in reversed(range(len(tsrt))):
+        allowed[i] = later.copy()
+        later |= masks[i]
+
+    todo = [i for i in range(len(tsrt)) if tsrt[i][1] > 0]
+    for squares,i in zip(layers_squareified,todo):
+        lines = hlineEncode(hlineRuns(masks[i],allowed[i]))
+        if dataSize('hline',[lines],vc) < dataSize('rect',[squares],vc):
+            layers.append(('hline',lines))
+        else:
+            layers.append(('rect',squares))
+    return layers,names,background_color
+
+def dataSize(compression,layers,vc):
+    if compression == 'hybrid':
+        return sum(dataSize(kind,[data],vc) for kind,data in layers)
+    count = sum(len(l) for l in layers)
+    if compression == 'rect':
+        return count*4*2 if vc == 0 else count*4
+    # hline layers are flat streams, words in gr8
+    return count*2 if vc == 0 else count
+
+def encode(fwd_T,vc,compression,path=None):
+    if compression == 'rect':
+        data = encodeRect(fwd_T,vc,path)
+    elif compression == 'hybrid':
+        data = encodeHybrid(fwd_T,vc,path)
+    else:
+        data = encodeHLine(fwd_T,vc)
+    return data, dataSize(compression,data[0],vc)
+
+def scoreModes(Ts,deltas,modes,compression,weights=AUTO_WEIGHTS):
+    # Ts/deltas are indexed like modes. every mode is encoded with every compression,
+    # the one used for scoring is `compression`. encoded results are returned so the
+    # winner does not have to be compressed again
+    candidates = []
+    encoded = {}
+    for idx,vc in enumerate(modes):
+        d = deltas[idx]
+        sizes = {}
+        encoded[vc] = {}
+        for comp in ('rect','hline'):
+            encoded[vc][comp] = encode(Ts[idx],vc,comp)
+            sizes[comp] = encoded[vc][comp][1]
+        if compression == 'hybrid':
+            # reuses the rectangles found above instead of running squareify again
+            data = encodeHybrid(Ts[idx],vc,rect=encoded[vc]['rect'][0])
+            encoded[vc]['hybrid'] = data,dataSize('hybrid',data[0],vc)
+            sizes['hybrid'] = encoded[vc]['hybrid'][1]
+
+        pct = float(np.percentile(d, AUTO_PERCENTILE))
+        candidate = {
+            "grmode": grmode_numbers[vc],
+            "vc": vc,
+            "delta_mean": float(d.mean()),
+            "delta_p"+str(AUTO_PERCENTILE): pct,
+            "delta_max": float(d.max()),
+            "delta_sum": float(d.sum()),
+            "bytes": sizes,
+        }
+        candidate["score"] = (weights.get("mean",0)*candidate["delta_mean"]
+                              + weights.get("pct",0)*pct
+                              + weights.get("kb",0)*sizes[compression]/1024)
+        candidates.append(candidate)
+
+    best = min(candidates, key=lambda c: c["score"])
+    return best["vc"],candidates,encoded
@@ -1,7 +1,7 @@
 import cv2.version
 import numpy as np
-import os
 import cv2
+import json
 import pascalgen
 import uuid
 import argparse
@@ -14,7 +14,9 @@ import argparse
 # 15: 160x192
 
 import atarimglib
+import artifacts
 import pascalgen
+import rasterizer
 
 
 parser = argparse.ArgumentParser(
@@ -22,113 +24,165 @@ parser = argparse.ArgumentParser(
                     description='generate images and gifs for atari 8bit computers',
                     epilog='for more info refer to source and comments')
 
-parser.add_argument('-c','--compression', required=False, choices=['rect','hline'] ,help='set compression type. you have to experiment to find one most suitable')
-parser.add_argument('-g', '--grmode', required=False, help='set graphical mode. optional (will generate all if not set)')
+parser.add_argument('-c','--compression', required=False, choices=['rect','hline','hybrid'] ,help='set compression type. you have to experiment to find one most suitable')
+parser.add_argument('-g', '--grmode', required=False, help='set graphical mode. optional (will generate all if not set)\n"auto" picks the best scoring mode without prompting')
+parser.add_argument('-w', '--weights', required=False, help='weights for -g auto as key=value pairs, e.g. mean=1,pct=0.5,kb=1')
+parser.add_argument('-r', '--report', required=False, help='where -g auto writes the json report of all candidates (default out/auto.json)')
+parser.add_argument('-j', '--jobs', required=False, type=int, help='processes used for rect compression. defaults to the number of usable cpus')
+parser.add_argument('-v', '--verify', required=False, action='store_true', help='replay the generated data in python and report pixel mismatches and drawing cost')
+parser.add_argument('-l', '--dump-layers', required=False, action='store_true', help='save every color layer to out/layers/ (rect and hybrid compression)')
+parser.add_argument('--in-memory', required=False, action='store_true', help="don't write anything to disk, main() returns the generated files instead")
 parser.add_argument('-m','--maxmem', required=False, help='work in progress. Compress until size matched set limit\nrecommended 15kb for 24kb roms, etc')
 parser.add_argument('image', type=argparse.FileType('r', encoding=None), nargs='+')
 
 parser.add_help = True
 
-filenames = [n.name for n in parser.parse_args().image]
-compressionmode = "rect"
-compressionmode = parser.parse_args().compression if parser.parse_args().compression != None else compressionmode
-print(compressionmode)
 
-if len(filenames) == 1:
-    img = cv2.imread(filenames[0])
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+def parseWeights(s):
+    weights = dict(atarimglib.AUTO_WEIGHTS)
+    if s is None:
+        return weights
+    for pair in s.split(','):
+        try:
+            key,value = pair.split('=')
+            value = float(value)
+        except ValueError:
+            parser.error("invalid weight "+repr(pair)+", use key=value pairs like mean=1,pct=0.5,kb=1")
+        if key not in weights:
+            parser.error("unknown weight "+key+", use one of "+",".join(weights.keys()))
+        weights[key] = value
+    return weights
+
+
+def main(argv=None):
+    # returns the files written in this run as {path: bytes} when --in-memory is set
+    args = parser.parse_args(argv)
+    artifacts.getWriter(in_memory=args.in_memory)
+    atarimglib.WORKERS = args.jobs
+
+    filenames = [n.name for n in args.image]
+    compressionmode = "rect"
+    compressionmode = args.compression if args.compression != None else compressionmode
+    print(compressionmode)
+
+    if len(filenames) == 1:
+        img = cv2.imread(filenames[0])
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    imgs = []
+    Ts = []
+    deltas = []
+
+    auto = args.grmode == "auto"
+    if args.grmode != None and not auto and args.grmode not in [str(n) for n in atarimglib.grmode_numbers]:
+        parser.error("invalid graphical mode "+args.grmode+", use auto or one of "+",".join(str(n) for n in atarimglib.grmode_numbers))
+    if not auto and (args.weights != None or args.report != None):
+        parser.error("-w and -r only work with -g auto")
+    report = args.report if args.report != None else "out/auto.json"
+
+    modes_to_process = range(0,len(atarimglib.grmode_names))
+    set_grmode = int(args.grmode) if args.grmode != None and not auto else None
+    if set_grmode:
+        print("loading only grmode", set_grmode)
+        modes_to_process = [atarimglib.grmode_numbers.index(set_grmode)]
+
+    for gr in modes_to_process:
+            x2,y2 = atarimglib.grmode_dims[gr]
+
+            scaled_img = cv2.resize(img, (x2, y2), interpolation = cv2.INTER_AREA)
+            print(x2,y2)
+            print(np.shape(scaled_img))
+            Ti = np.zeros((x2,y2), dtype=np.uint8)
+            deltas += [atarimglib.posterize(scaled_img,Ti, gr)]
+            imgs += [scaled_img]
+            Ts += [Ti]
+            sc = cv2.cvtColor(scaled_img,cv2.COLOR_BGR2RGB)
+            artifacts.imwrite("out/"+atarimglib.grmode_names[gr], sc)
+
+    encoded = None
+    if len(modes_to_process)==1:
+        vc = modes_to_process[0]
+        fwd_img = imgs[0]
+        fwd_T = Ts[0]
+        fwd_delta = deltas[0]
 
-try:
-    os.mkdir("out")
-except Exception:
-    pass
-
-imgs = []
-Ts = []
-
-set_grmode = -1
-
-
-modes_to_process = range(0,len(atarimglib.grmode_names))
-set_grmode = 0
-set_grmode = int(parser.parse_args().grmode) if parser.parse_args().grmode != None else None
-if set_grmode:
-    print("loading only grmode", set_grmode)
-    if set_grmode > 11:
-        set_grmode-=2
-    modes_to_process = [set_grmode-8]
-
-for gr in modes_to_process:
-        x2,y2 = atarimglib.grmode_dims[gr]
-
-        scaled_img = cv2.resize(img, (x2, y2), interpolation = cv2.INTER_AREA)
-        print(x2,y2)
-        print(np.shape(scaled_img))
-        Ti = np.zeros((x2,y2), dtype=np.uint8)
-        atarimglib.posterize(scaled_img,Ti, gr)
-        imgs += [scaled_img]
-        Ts += [Ti]
-        sc = cv2.cvtColor(scaled_img,cv2.COLOR_BGR2RGB)
-        cv2.imwrite("out/"+atarimglib.grmode_names[gr], sc)
-
-if len(modes_to_process)==1:
-    vc = set_grmode-8
-    fwd_img = imgs[0]
-    fwd_T = Ts[0]
-
-else:
-    vc = atarimglib.prompt()
-        
-    fwd_img = imgs[vc]
-    fwd_T = Ts[vc]
-
-del Ts
-del imgs
+    else:
+        if auto:
+            weights = parseWeights(args.weights)
+            vc,candidates,encoded = atarimglib.scoreModes(Ts,deltas,modes_to_process,compressionmode,weights)
+            for c in candidates:
+                print("gr"+str(c["grmode"]), "score:", round(c["score"],3), "mean dE:", round(c["delta_mean"],3), "bytes:", c["bytes"])
+            print("auto selected gr"+str(atarimglib.grmode_numbers[vc]))
 
-cv2.imwrite("out/fwd.png", fwd_img)
+            artifacts.writeFile(report, json.dumps({"compression": compressionmode, "weights": weights,
+                       "selected": atarimglib.grmode_numbers[vc], "candidates": candidates}, indent=4))
+        else:
+            vc = atarimglib.prompt()
 
+        fwd_img = imgs[vc]
+        fwd_T = Ts[vc]
+        fwd_delta = deltas[vc]
 
+    print("delta sum:", float(fwd_delta.sum()), "mean:", float(fwd_delta.mean()))
 
-program_uuid = str(uuid.uuid4()).split('-')[0]
+    del Ts
+    del imgs
 
-program = ""
+    artifacts.imwrite("out/fwd.png", fwd_img)
 
-if compressionmode == 'rect':
-    layers_T,counts = atarimglib.layerize(fwd_T,vc)
 
-    tsrt = []
-    for i in range(len(atarimglib.grmode_colors[vc])):
-        tsrt.append([layers_T[i], counts[i],i])
-    tsrt = sorted(tsrt, key = lambda x : x[1], reverse=True)
 
-    if not atarimglib.BYPASSBGSETTING:
-        background_color = tsrt[0][2]
-        tsrt = tsrt[1:]
-        print("background color:", background_color)
+    program_uuid = str(uuid.uuid4()).split('-')[0]
 
-    atarimglib.squarecount = 0
-    layers_squareified,names = atarimglib.genLayerSquares(tsrt,vc,"out/layers/")
+    program = ""
 
-    if set_grmode == 8:
-        print(atarimglib.squarecount*4*2,"bytes used for raw data")
+    if encoded:
+        data,nbytes = encoded[vc][compressionmode]
+        # auto mode encoded without dumping, so dump the winner's layers here
+        if args.dump_layers and compressionmode in ('rect','hybrid'):
+            atarimglib.dumpLayers(atarimglib.sortLayers(fwd_T,vc)[0],"out/layers/")
     else:
-        print(atarimglib.squarecount*4,"bytes used for raw data")
-
-    program=pascalgen.genPascalSQ(layers_squareified,names,vc, program_uuid,atarimglib.BYPASSBGSETTING,background_color,atarimglib.grmode_dims)
-
-elif compressionmode == 'hline':
-    lines_layers,names = atarimglib.genLayerHLines(fwd_T,vc,"out/layers/")
-    count = 0
-    for l in lines_layers:
-        count += len(l)
-    print(count*2, "bytes used for raw data")
-    #print(lines_layers)
-    s = "uses crt,fastgraph;\n\n"
-    s+=pascalgen.genConstHL(lines_layers,names,program_uuid)
-    s+=pascalgen.genProgHL(lines_layers,names,program_uuid,atarimglib.grmode_dims,vc)
-    s+="\nrepeat until false;\nend."
-    program = s
-
-f = open("./image.pas","w")
-f.write(program)
-f.close()
\ No newline at end of file
+        data,nbytes = atarimglib.encode(fwd_T,vc,compressionmode,"out/layers/" if args.dump_layers else None)
+
+    if compressionmode == 'rect':
+        layers_squareified,names,background_color = data
+        if not atarimglib.BYPASSBGSETTING:
+            print("background color:", background_color)
+        print(nbytes,"bytes used for raw data")
+
+        program=pascalgen.genPascalSQ(layers_squareified,names,vc, program_uuid,atarimglib.BYPASSBGSETTING,background_color,atarimglib.grmode_dims)
+        if args.verify:
+            fb,stats = rasterizer.replaySQ(layers_squareified,names,vc,atarimglib.BYPASSBGSETTING,background_color,atarimglib.grmode_dims)
+
+    elif compressionmode == 'hybrid':
+        layers,names,background_color = data
+        kinds = [kind for kind,d in layers]
+        print(kinds.count('rect'),"rect layers,",kinds.count('hline'),"hline layers")
+        print(nbytes,"bytes used for raw data")
+
+        program=pascalgen.genPascalHybrid(layers,names,vc, program_uuid,atarimglib.BYPASSBGSETTING,background_color,atarimglib.grmode_dims)
+        if args.verify:
+            fb,stats = rasterizer.replayHybrid(layers,names,vc,atarimglib.BYPASSBGSETTING,background_color,atarimglib.grmode_dims)
+
+    elif compressionmode == 'hline':
+        lines_layers,names = data
+        print(nbytes, "bytes used for raw data")
+        #print(lines_layers)
+        s = "uses crt,fastgraph;\n\n"
+        s+=pascalgen.genConstHL(lines_layers,names,program_uuid,pascalgen.dataType(vc))
+        s+=pascalgen.genProgHL(lines_layers,names,program_uuid,atarimglib.grmode_dims,vc,pascalgen.dataType(vc))
+        s+="\nrepeat until false;\nend."
+        program = s
+        if args.verify:
+            fb,stats = rasterizer.replayHL(lines_layers,names,vc,atarimglib.grmode_dims)
+
+    if args.verify:
+        print("verify:", rasterizer.verify(fb,fwd_T,stats))
+
+    artifacts.writeFile("image.pas", program)
+
+    return artifacts.closeWriter()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,31 +6,51 @@ uses crt, fastgraph;
 const
 """
 
+# interprets the stream built by atarimglib.hlineEncode
+# op 0: row of n runs, op 1: skip n rows, op 2: repeat last row n times
 procedureHLDraw = """
 procedure drawCol(mxi:word;color:byte);
+var
+	op,n,k,r,j,last,lastn:word;
 begin
 for c:=0 to 1 do begin
 	SetColor(color*c);
 	y:=0;
 	i:=0;
-	repeat
-		if i > mxi then
-			Break;
-		if ptr[i*2] = 81 then
+	last:=0;
+	lastn:=0;
+	while i < mxi do
+	begin
+		op:=ptr[i];
+		n:=ptr[i+1];
+		i:=i+2;
+		if op = 0 then
 		begin
-			i:=i+1;
+			last:=i;
+			lastn:=n;
+			for k:=1 to n do
+			begin
+				HLine(ptr[i],ptr[i+1],y);
+				i:=i+2;
+			end;
 			y:=y+1;
-			Continue;
 		end;
-		if ptr[i*2] = 82 then
+		if op = 1 then
+			y:=y+n;
+		if op = 2 then
 		begin
-			y:=y+ptr[i*2+1];
-			i:=i+1;
-			Continue;
+			for r:=1 to n do
+			begin
+				j:=last;
+				for k:=1 to lastn do
+				begin
+					HLine(ptr[j],ptr[j+1],y);
+					j:=j+2;
+				end;
+				y:=y+1;
+			end;
 		end;
-		HLine(ptr[i*2],ptr[i*2+1],y);
-		i:=i+1;
-	until i =mxi+1;
+	end;
 	end;
 end;
 """
@@ -143,15 +163,26 @@ def genProgramSQ(layers_squareified,names, program_uuid):
     
     return program_str
 
-def genPascalSQ(layers_squareified,names,vc, program_uuid, BYPASSBGSETTING,background_color,grmode_dims):
+def grmodeNumber(vc):
     set_grmode = vc+8
     if set_grmode>11:
         set_grmode+=2
+    return set_grmode
+
+def dataType(vc):
+    # gr8 is 320 pixels wide, so coordinates don't fit in a byte
+    return 'word' if vc == 0 else 'byte'
+
+def genProcedureB(dtype='byte'):
+    return procedureB.replace("x1,y1,x2,y2:byte","x1,y1,x2,y2:"+dtype).replace("x,y,xw,yh:byte","x,y,xw,yh:"+dtype)
+
+def genPascalSQ(layers_squareified,names,vc, program_uuid, BYPASSBGSETTING,background_color,grmode_dims):
+    set_grmode = grmodeNumber(vc)
 
     textdata = pascalBegin + genConstSQ(layers_squareified,program_uuid,set_grmode,names)
     textdata += "var\n\ti:dword;"
 
-    textdata += procedureB
+    textdata += genProcedureB(dataType(vc))
 
     textdata += "\nbegin\n"
     textdata += "\tinitgraph(16+"+str(set_grmode)+");\n"
@@ -161,33 +192,59 @@ def genPascalSQ(layers_squareified,names,vc, program_uuid, BYPASSBGSETTING,backg
     textdata += "\trepeat until false;\nend."
     return textdata
 
-# layers_lines = [y,[[x,ctr]...]]
-# layers_colors= [  [ c     ...]]
-def genConstHL(layers_lines,layers_names,program_uuid, dtype='byte'):
-	textdata = "const\n\t"
+# layers = [(kind, data)...] from atarimglib.encodeHybrid, kind is 'rect' or 'hline'
+def genPascalHybrid(layers,names,vc, program_uuid, BYPASSBGSETTING,background_color,grmode_dims):
+    set_grmode = grmodeNumber(vc)
+    dtype = dataType(vc)
+    rect = [(data,name) for (kind,data),name in zip(layers,names) if kind == 'rect']
+    hline = [(data,name) for (kind,data),name in zip(layers,names) if kind == 'hline']
+
+    textdata = pascalBegin + genConstSQ([d for d,n in rect],program_uuid,set_grmode,[n for d,n in rect])
+    textdata += genConstHL([d for d,n in hline],[n for d,n in hline],program_uuid,dtype,header=False)
+    textdata += "\nvar\n\ti:dword;\n\ty,c:byte;\n\tptr:^"+dtype+";"
+
+    textdata += genProcedureB(dtype)
+    textdata += procedureHLDraw
+
+    textdata += "\nbegin\n"
+    textdata += "\tinitgraph(16+"+str(set_grmode)+");\n"
+    if not BYPASSBGSETTING:
+        textdata += "\tSetColor("+str(background_color)+");\n\tB(0,0,"+str(grmode_dims[vc][0])+","+str(grmode_dims[vc][1])+");\n"
+    for (kind,data),name in zip(layers,names):
+        if kind == 'rect':
+            textdata += genProgramSQ([data],[name], program_uuid)
+        else:
+            textdata += genCallHL(data,name,program_uuid)
+    textdata += "\trepeat until false;\nend."
+    return textdata
+
+# layers_lines = [[op,n,...]...] streams from atarimglib.hlineEncode
+# layers_names = [  c     ...]
+def genConstHL(layers_lines,layers_names,program_uuid, dtype='byte', header=True):
+	textdata = "const\n\t" if header else "\t"
 	for i in range(len(layers_names)):
 		color = layers_names[i]
 		textdata += "\tdata_"+program_uuid+"_"+str(color)
-		textdata += ": array [0.."+str(2*len(layers_lines[i])-1)+"]"
+		textdata += ": array [0.."+str(len(layers_lines[i])-1)+"]"
 		textdata += " of "+dtype+" = ("
 		for c in layers_lines[i]:
-			textdata += str(c[0])+","+str(c[1])+","
+			textdata += str(c)+","
 		textdata = textdata[:-1]
 		textdata += ");\n\t"
 	return textdata
 
 def genProgHL(layers_lines,layers_names,program_uuid,grmode_dims,vc,  dtype='byte'):
-	program_str = "\nvar\n\ti:word;\n\ty,c:byte;\n\tptr:^byte;"
+	program_str = "\nvar\n\ti:word;\n\ty,c:byte;\n\tptr:^"+dtype+";"
 	program_str += procedureHLDraw 
-	program_str += "\nbegin\n\tInitGraph("+str(vc+8)+"+16);\n"
+	program_str += "\nbegin\n\tInitGraph("+str(grmodeNumber(vc))+"+16);\n"
 	for i in range(len(layers_names)):
-		y = layers_lines[i][0]
-		color = layers_names[i]
-		color = str(color)
-		ln = len(layers_lines[i])
-		y = str(y)
-		data = "data_"+program_uuid+"_"+str(color)
-		program_str += "\tptr := @"+data+";\n"
-		program_str += "\tdrawCol("+str(ln)+","+color+");\n"
+		program_str += genCallHL(layers_lines[i],layers_names[i],program_uuid)
+
+	return program_str
 
+def genCallHL(lines,color,program_uuid):
+	color = str(color)
+	data = "data_"+program_uuid+"_"+color
+	program_str = "\tptr := @"+data+";\n"
+	program_str += "\tdrawCol("+str(len(lines))+","+color+");\n"
 	return program_str
\ No newline at end of file
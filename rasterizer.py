@@ -0,0 +1,107 @@
+import numpy as np
+import atarimglib
+import pascalgen
+
+# replays the data pascalgen emits the same way the generated pascal program
+# draws it, so compression changes can be checked without mp, mads and an emulator.
+# the framebuffer is indexed [y][x] and holds color ids, like the layers in atarimglib
+
+def newStats():
+    return {"hline_calls": 0, "line_calls": 0, "pixels_written": 0}
+
+def newFramebuffer(vc, grmode_dims):
+    # initgraph clears the screen to color 0
+    return np.zeros((grmode_dims[vc][1], grmode_dims[vc][0]), np.uint8)
+
+def clip(fb, x1, y1, x2, y2):
+    # inclusive coordinates in, slice bounds out. None if nothing is on screen
+    x1,x2 = max(min(x1,x2),0), min(max(x1,x2),fb.shape[1]-1)
+    y1,y2 = max(min(y1,y2),0), min(max(y1,y2),fb.shape[0]-1)
+    if x1 > x2 or y1 > y2:
+        return None
+    return slice(y1,y2+1), slice(x1,x2+1)
+
+def HLine(fb, x1, x2, y, color, stats):
+    stats["hline_calls"] += 1
+    s = clip(fb, x1, y, x2, y)
+    if s is None:
+        return
+    fb[s] = color
+    stats["pixels_written"] += s[1].stop - s[1].start
+
+def B(fb, x1, y1, x2, y2, color, stats, dtype='byte'):
+    # with byte arguments wider coordinates wrap like they do on the atari
+    if dtype == 'byte':
+        x1,y1,x2,y2 = x1 & 0xff, y1 & 0xff, x2 & 0xff, y2 & 0xff
+    rows = max(y1,y2) - min(y1,y2) + 1
+    # every line is drawn in color 0 first unless the color already is 0
+    passes = 2 if color != 0 else 1
+    if x1 != x2:
+        stats["hline_calls"] += rows*passes
+    else:
+        stats["line_calls"] += passes
+
+    s = clip(fb, x1, y1, x2, y2)
+    if s is None:
+        return
+    fb[s] = color
+    stats["pixels_written"] += (s[0].stop-s[0].start) * (s[1].stop-s[1].start) * passes
+
+def drawCol(fb, stream, color, stats):
+    # drawCol in pascalgen.procedureHLDraw, see atarimglib.hlineEncode for the format
+    for c in range(0,2):
+        y = 0
+        i = 0
+        last = []
+        while i < len(stream):
+            op,n = stream[i],stream[i+1]
+            i += 2
+            if op == atarimglib.HL_ROW:
+                last = [(stream[j],stream[j+1]) for j in range(i,i+2*n,2)]
+                i += 2*n
+                rows = 1
+            elif op == atarimglib.HL_SKIP:
+                y += n
+                continue
+            elif op == atarimglib.HL_REPEAT:
+                rows = n
+            for r in range(rows):
+                for x1,x2 in last:
+                    HLine(fb, x1, x2, y, color*c, stats)
+                y += 1
+
+def replaySQ(layers_squareified, names, vc, BYPASSBGSETTING, background_color, grmode_dims):
+    # same arguments as pascalgen.genPascalSQ
+    layers = [('rect',squares) for squares in layers_squareified]
+    return replayHybrid(layers, names, vc, BYPASSBGSETTING, background_color, grmode_dims)
+
+def replayHL(layers_lines, names, vc, grmode_dims):
+    # same arguments as pascalgen.genProgHL
+    fb = newFramebuffer(vc, grmode_dims)
+    stats = newStats()
+    for i in range(len(names)):
+        drawCol(fb, layers_lines[i], names[i], stats)
+    return fb, stats
+
+def replayHybrid(layers, names, vc, BYPASSBGSETTING, background_color, grmode_dims):
+    # same arguments as pascalgen.genPascalHybrid
+    fb = newFramebuffer(vc, grmode_dims)
+    stats = newStats()
+    dtype = pascalgen.dataType(vc)
+    if not BYPASSBGSETTING:
+        B(fb, 0, 0, grmode_dims[vc][0], grmode_dims[vc][1], background_color, stats, dtype)
+    for (kind,data),name in zip(layers,names):
+        if kind == 'rect':
+            for x1,y1,x2,y2 in data:
+                B(fb, x1, y1, x2, y2, name, stats, dtype)
+        else:
+            drawCol(fb, data, name, stats)
+    return fb, stats
+
+def verify(fb, Ti, stats):
+    # Ti is indexed [x][y] like in main.py
+    mismatch = fb != np.asarray(Ti).T
+    report = dict(stats)
+    report["mismatches"] = int(mismatch.sum())
+    report["pixels"] = int(mismatch.size)
+    return report